@@ -1,93 +1,303 @@
-from transformers import pipeline
+import hashlib
+import os
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
 
-# Specify the model name and revision
-model_name = "facebook/bart-large-mnli"  # Model for zero-shot classification
-revision = "main"
+import orjson
+import torch
+import torch.nn.functional as F
+from prometheus_client import Histogram
+from torch.nn.utils.rnn import pad_sequence
 
-# Initialize the pipeline with the 'device' argument set to 0 to use GPU (if available)
-# If using CPU, set device=-1 (which is the default)
-classifier = pipeline("zero-shot-classification", model=model_name, revision=revision, device=-1)
+from model_loader import get_classifier
 
+# Maximum length in tokens of each premise/hypothesis pair. Attention cost grows
+# quadratically with the length, and MNLI rarely benefits from long premises
+MAX_SEQUENCE_LENGTH = int(os.getenv("MAX_SEQUENCE_LENGTH", "512"))
 
-def categorize_text_with_tags_and_category(text: str, tags=None, category=None, candidate_labels=None, top_k=10):
-    # Define default candidate labels in Portuguese if none are provided
+# Maximum length in tokens of a hypothesis, so a long tag or category cannot crowd out the premise
+MAX_HYPOTHESIS_LENGTH = int(os.getenv("MAX_HYPOTHESIS_LENGTH", "64"))
+
+# Maximum number of premise/hypothesis pairs scored in a single forward pass
+MAX_BATCH_PAIRS = int(os.getenv("MAX_BATCH_PAIRS", "64"))
+
+# Sequence lengths are padded up to a multiple of this, so the CPU GEMM kernels run on
+# whole tiles instead of falling back to tail handling (1 disables the extra padding)
+PAD_TO_MULTIPLE_OF = int(os.getenv("PAD_TO_MULTIPLE_OF", "32"))
+
+# Number of categorization results kept in the LRU result cache (0 disables it)
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "4096"))
+
+# Same hypothesis template the zero-shot pipeline uses by default
+hypothesis_template = "This example is {}."
+
+# Default candidate labels in Portuguese, frozen so they are not rebuilt on every call.
+# The accented labels are normalized to NFC and interned once here, so the tokenizer
+# gets canonical strings and the set/dict lookups can match them by identity
+DEFAULT_CANDIDATE_LABELS = tuple(sys.intern(unicodedata.normalize("NFC", label)) for label in (
+    "Desafios e Tendências",
+    "Filmes e Séries",
+    "Reações e Comentários",
+    "Gameplay",
+    "Esports",
+    "Skits e Paródias",
+    "Comédia e Humor",
+    "Vlogs",
+    "Lifestyle e Produtividade",
+    "Tutoriais",
+    "Explicações e Análises",
+    "Música",
+    "Desafios Musicais",
+    "Gastronomia",
+    "Tecnologia",
+    "Viagens",
+    "DIY (Faça Você Mesmo)",
+    "Educação",
+    "Ciência e Inovação",
+    "Notícias",
+    "Reações a Vídeos",
+    "Reações a Filmes e Séries",
+    "Reações Musicais",
+    "Reações a Gameplay",
+    "Reações a Vídeos Virais",
+    "Reações a Tendências e Notícias",
+    "Reações a Eventos",
+    "Reações a Lançamentos de Tecnologia",
+    "Reações de Comida",
+    "Reações a Comédia",
+    "Tecnologia e Inovação",
+    "História e Cultura",
+    "Entrevistas",
+    "Desenvolvimento Pessoal",
+    "True Crime",
+    "Entretenimento",
+    "Política e Atualidades",
+    "Economia",
+    "Saúde",
+    "Filosofia e Religião",
+    "Futuro do Trabalho",
+    "Diversidade",
+    "Aventuras e Viagens",
+    "Cinema e Séries",
+    "Livros e Literatura",
+))
+
+
+def get_entailment_id(model):
+    """Index of the "entailment" logit in the MNLI classification head."""
+    return next(
+        (idx for label, idx in model.config.label2id.items() if label.lower().startswith("entail")), -1
+    )
+
+
+def encode_hypothesis(tokenizer, label: str):
+    """Tokenize the hypothesis built for a label, without special tokens."""
+    return tokenizer(hypothesis_template.format(label), add_special_tokens=False)["input_ids"]
+
+
+@lru_cache(maxsize=1)
+def get_hypothesis_ids():
+    """Pre-tokenize the hypotheses of the default labels once, when the model is first used."""
+    tokenizer, _ = get_classifier()
+    return {label: encode_hypothesis(tokenizer, label) for label in DEFAULT_CANDIDATE_LABELS}
+
+
+# Model forward time per premise/hypothesis pair, to catch regressions from quantization or
+# thread settings independently of batch size; cache hits never reach the model
+CLASSIFY_PAIR_LATENCY = Histogram(
+    "classify_pair_seconds",
+    "Time spent in the zero-shot model forward passes, per premise/hypothesis pair",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+# Number of premise/hypothesis pairs scored per classification
+CLASSIFY_BATCH_PAIRS = Histogram(
+    "classify_batch_pairs",
+    "Number of premise/hypothesis pairs scored by the zero-shot model per classification",
+    buckets=(8, 16, 32, 64, 128, 256, 512),
+)
+
+# Categorization results keyed by a digest of their inputs, so re-queued
+# transcriptions skip the model. Shared by the HTTP and consumer threads
+result_cache = OrderedDict()
+result_cache_lock = threading.Lock()
+
+
+def result_cache_key(text: str, tags=None, category=None, candidate_labels=None, top_k=10):
+    """Short digest of everything a categorization result depends on."""
+    key_data = orjson.dumps([text, sorted(tags or ()), category, candidate_labels, top_k])
+    return hashlib.blake2b(key_data, digest_size=16).digest()
+
+
+def get_cached_result(key):
+    """Return a copy of the cached result for a key, or None if it is not cached."""
+    with result_cache_lock:
+        result = result_cache.get(key)
+        if result is None:
+            return None
+        result_cache.move_to_end(key)
+    return [dict(entry) for entry in result]
+
+
+def cache_result(key, result):
+    """Cache a result, evicting the least recently used one when the cache is full."""
+    with result_cache_lock:
+        result_cache[key] = [dict(entry) for entry in result]
+        result_cache.move_to_end(key)
+        while len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)
+
+
+def build_candidate_labels(tags=None, category=None, candidate_labels=None):
+    """Return the candidate labels for a text, with its category and tags added."""
+    # Use the default candidate labels in Portuguese if none are provided
     if candidate_labels is None:
-        candidate_labels = [
-            "Desafios e Tendências",
-            "Filmes e Séries",
-            "Reações e Comentários",
-            "Gameplay",
-            "Esports",
-            "Skits e Paródias",
-            "Comédia e Humor",
-            "Vlogs",
-            "Lifestyle e Produtividade",
-            "Tutoriais",
-            "Explicações e Análises",
-            "Música",
-            "Desafios Musicais",
-            "Gastronomia",
-            "Tecnologia",
-            "Viagens",
-            "DIY (Faça Você Mesmo)",
-            "Educação",
-            "Ciência e Inovação",
-            "Notícias",
-            "Reações a Vídeos",
-            "Reações a Filmes e Séries",
-            "Reações Musicais",
-            "Reações a Gameplay",
-            "Reações a Vídeos Virais",
-            "Reações a Tendências e Notícias",
-            "Reações a Eventos",
-            "Reações a Lançamentos de Tecnologia",
-            "Reações de Comida",
-            "Reações a Comédia",
-            "Tecnologia e Inovação",
-            "História e Cultura",
-            "Entrevistas",
-            "Desenvolvimento Pessoal",
-            "True Crime",
-            "Entretenimento",
-            "Política e Atualidades",
-            "Economia",
-            "Saúde",
-            "Filosofia e Religião",
-            "Futuro do Trabalho",
-            "Diversidade",
-            "Aventuras e Viagens",
-            "Cinema e Séries",
-            "Livros e Literatura"
-        ]
+        candidate_labels = DEFAULT_CANDIDATE_LABELS
+
+    # Copy the labels only when the category or tags have to be added to them
+    if category or tags:
+        candidate_labels = list(candidate_labels)
+
+        # Keep the labels already present in a set, so each membership check is O(1)
+        seen_labels = set(candidate_labels)
 
-    # Add the video category to the candidate labels if provided
-    if category and category not in candidate_labels:
-        candidate_labels.append(category)
+        # Add the video category to the candidate labels if provided
+        if category and category not in seen_labels:
+            seen_labels.add(category)
+            candidate_labels.append(category)
 
-    # If tags are provided, include them in the candidate labels
-    if tags:
-        for tag in tags:
-            if tag not in candidate_labels:
+        # If tags are provided, include them in the candidate labels
+        for tag in tags or ():
+            if tag not in seen_labels:
+                seen_labels.add(tag)
                 candidate_labels.append(tag)
 
-    if not text:
-        raise ValueError("Input text cannot be empty")
+    return candidate_labels
+
+
+def encode_pairs(tokenizer, text: str, candidate_labels):
+    """Build the premise/hypothesis input ids of a text for each candidate label."""
+    # Reuse the cached hypothesis tokens; only labels outside the defaults are tokenized here
+    cached_hypothesis_ids = get_hypothesis_ids()
+    hypothesis_ids = [
+        cached_hypothesis_ids[label] if label in cached_hypothesis_ids else encode_hypothesis(tokenizer, label)
+        for label in candidate_labels
+    ]
+
+    # Tokens available for the premise and hypothesis of each pair
+    pair_budget = max(
+        0, min(tokenizer.model_max_length, MAX_SEQUENCE_LENGTH) - tokenizer.num_special_tokens_to_add(pair=True)
+    )
+    # Cap the hypotheses, keeping at least half of the budget for the premise
+    max_hypothesis_length = min(MAX_HYPOTHESIS_LENGTH, pair_budget // 2)
+
+    # Tokenize the premise once; each pair then truncates it to fit MAX_SEQUENCE_LENGTH with its own
+    # hypothesis, so a long label only shortens its own pair. The ids are truncated here rather than by
+    # the tokenizer: changing its truncation settings between calls mutates the shared fast tokenizer
+    premise_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    pairs = []
+    for ids in hypothesis_ids:
+        ids = ids[:max_hypothesis_length]
+        pairs.append(torch.tensor(
+            tokenizer.build_inputs_with_special_tokens(premise_ids[:pair_budget - len(ids)], ids)
+        ))
+    return pairs
+
+
+def entailment_logits(tokenizer, model, pairs):
+    """Run the model over the premise/hypothesis pairs and return their entailment logits."""
+    entailment_id = get_entailment_id(model)
+    logits = []
+    # Batch up to MAX_BATCH_PAIRS pairs in each forward pass to bound memory use
+    for start in range(0, len(pairs), MAX_BATCH_PAIRS):
+        batch = pairs[start:start + MAX_BATCH_PAIRS]
+
+        # Build one padded (batch_size, seq_len) batch, seq_len rounded up to a multiple of PAD_TO_MULTIPLE_OF
+        input_ids = pad_sequence(batch, batch_first=True, padding_value=tokenizer.pad_token_id)
+        extra_padding = -input_ids.shape[1] % PAD_TO_MULTIPLE_OF
+        if extra_padding:
+            input_ids = F.pad(input_ids, (0, extra_padding), value=tokenizer.pad_token_id)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, pair in enumerate(batch):
+            attention_mask[row, :len(pair)] = 1
+
+        logits.append(model(input_ids=input_ids, attention_mask=attention_mask).logits[:, entailment_id])
+    return torch.cat(logits)
+
+
+# Inference only: disable autograd tracking (and tensor version counters) for the whole call
+@torch.inference_mode()
+def categorize_texts_with_tags_and_categories(texts, tags=None, categories=None, candidate_labels=None, top_k=10):
+    """Categorize several texts at once, scoring the pairs of all the texts together.
 
-    # Perform the zero-shot classification
-    result = classifier(text, candidate_labels, multi_label=False)
+    `tags` and `categories` hold the tags and category of each text, in the same order as `texts`.
+    """
+    if not texts:
+        return []
 
-    # Combine categories and scores into a list of dictionaries
-    categorized_results = [
-        {"category": label, "score": score}
-        for label, score in zip(result['labels'][:top_k], result['scores'][:top_k])
+    tags = tags or [None] * len(texts)
+    categories = categories or [None] * len(texts)
+
+    if not all(texts):
+        raise ValueError("Input text cannot be empty")
+
+    # Reuse the cached results; only the other texts go through the model
+    keys = [
+        result_cache_key(text, text_tags, text_category, candidate_labels, top_k)
+        for text, text_tags, text_category in zip(texts, tags, categories)
     ]
+    results = [get_cached_result(key) for key in keys]
+    pending = [idx for idx, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+
+    tokenizer, model = get_classifier()
+
+    # Build the candidate labels and premise/hypothesis pairs of every pending text
+    labels_per_text = []
+    pairs = []
+    for idx in pending:
+        text_labels = build_candidate_labels(tags[idx], categories[idx], candidate_labels)
+        labels_per_text.append(text_labels)
+        pairs.extend(encode_pairs(tokenizer, texts[idx], text_labels))
+
+    # Perform the zero-shot classification of all the pending texts together
+    started = time.perf_counter()
+    logits = entailment_logits(tokenizer, model, pairs)
+    CLASSIFY_PAIR_LATENCY.observe((time.perf_counter() - started) / len(pairs))
+    CLASSIFY_BATCH_PAIRS.observe(len(pairs))
+
+    text_logits_list = logits.split([len(text_labels) for text_labels in labels_per_text])
+    for idx, text_labels, text_logits in zip(pending, labels_per_text, text_logits_list):
+        scores = text_logits.softmax(dim=-1)
 
-    return categorized_results
+        # Select only the top_k best scores instead of sorting all the labels
+        top_scores, top_indices = torch.topk(scores, k=min(top_k, len(text_labels)))
+
+        # Combine categories and scores into a list of dictionaries, best match first
+        results[idx] = [
+            {"category": text_labels[label_idx], "score": score}
+            for label_idx, score in zip(top_indices.tolist(), top_scores.tolist())
+        ]
+        cache_result(keys[idx], results[idx])
+
+    return results
+
+
+def categorize_text_with_tags_and_category(text: str, tags=None, category=None, candidate_labels=None, top_k=10):
+    return categorize_texts_with_tags_and_categories(
+        [text], tags=[tags], categories=[category], candidate_labels=candidate_labels, top_k=top_k
+    )[0]
 
 
-# Example Usage
-text = "As últimas inovações em IA e aprendizado de máquina estão transformando as indústrias."
-tags = ["IA", "Tecnologia", "Inovação"]
-category = "Tecnologia"  # e.g., category retrieved from YouTube API
-result = categorize_text_with_tags_and_category(text, tags, category, top_k=10)
-print(result)  # Output: {'categories': ['Tecnologia', 'Ciência', 'Negócios'], 'scores': [0.89, 0.08, 0.03]}
+if __name__ == "__main__":
+    # Example Usage
+    text = "As últimas inovações em IA e aprendizado de máquina estão transformando as indústrias."
+    tags = ["IA", "Tecnologia", "Inovação"]
+    category = "Tecnologia"  # e.g., category retrieved from YouTube API
+    result = categorize_text_with_tags_and_category(text, tags, category, top_k=10)
+    print(result)  # Output: {'categories': ['Tecnologia', 'Ciência', 'Negócios'], 'scores': [0.89, 0.08, 0.03]}
@@ -0,0 +1,8 @@
+#!/bin/sh
+# Derive the OpenMP/MKL thread pools from INFERENCE_THREADS at run time, so overriding
+# it with `docker run -e INFERENCE_THREADS=...` keeps all of them consistent.
+# OMP_NUM_THREADS/MKL_NUM_THREADS can still be set explicitly to override them
+export OMP_NUM_THREADS="${OMP_NUM_THREADS:-$INFERENCE_THREADS}"
+export MKL_NUM_THREADS="${MKL_NUM_THREADS:-$INFERENCE_THREADS}"
+
+exec "$@"
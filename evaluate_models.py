@@ -0,0 +1,97 @@
+"""Compare the top-k categories of two zero-shot models on held-out transcriptions.
+
+Each model runs in its own process through the service's categorization code (same
+quantization, truncation and labels), selected with the MODEL_NAME environment variable.
+
+Usage:
+    python evaluate_models.py transcriptions.txt [--baseline MODEL] [--candidate MODEL] [--top-k K]
+
+`transcriptions.txt` holds one transcription per line.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BASELINE_MODEL = "facebook/bart-large-mnli"
+CANDIDATE_MODEL = "valhalla/distilbart-mnli-12-3"
+
+# Minimum top-1 agreement with the baseline for the candidate to be considered a drop-in replacement
+MIN_TOP1_AGREEMENT = 0.9
+
+
+def read_transcriptions(path: str):
+    """Read the non-empty lines of a file, one transcription per line."""
+    with open(path, encoding="utf-8") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def predict(path: str, top_k: int):
+    """Print the top-k categories of each transcription, with the model selected by MODEL_NAME."""
+    # Imported here so MODEL_NAME is read from the environment of this process
+    from categorization import categorize_text_with_tags_and_category
+
+    predictions = [
+        [entry["category"] for entry in categorize_text_with_tags_and_category(text, top_k=top_k)]
+        for text in read_transcriptions(path)
+    ]
+    print(json.dumps(predictions, ensure_ascii=False))
+
+
+def run_model(model: str, path: str, top_k: int):
+    """Categorize the transcriptions with a model in a separate process and return its predictions."""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), path, "--predict", "--top-k", str(top_k)],
+        env={**os.environ, "MODEL_NAME": model, "RESULT_CACHE_SIZE": "0"},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # The predictions are the last line, any earlier output comes from the libraries
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(baseline_predictions, candidate_predictions, top_k: int):
+    """Top-1 agreement and mean top-k overlap of the candidate predictions with the baseline."""
+    top1_agreement = sum(
+        baseline[0] == candidate[0] for baseline, candidate in zip(baseline_predictions, candidate_predictions)
+    ) / len(baseline_predictions)
+    topk_overlap = sum(
+        len(set(baseline) & set(candidate)) / top_k
+        for baseline, candidate in zip(baseline_predictions, candidate_predictions)
+    ) / len(baseline_predictions)
+    return top1_agreement, topk_overlap
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the top-k categories of two zero-shot models.")
+    parser.add_argument("transcriptions", help="file with one transcription per line")
+    parser.add_argument("--baseline", default=BASELINE_MODEL)
+    parser.add_argument("--candidate", default=CANDIDATE_MODEL)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--predict", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.predict:
+        predict(args.transcriptions, args.top_k)
+        return
+
+    if not read_transcriptions(args.transcriptions):
+        parser.error(f"no transcriptions in {args.transcriptions}")
+
+    baseline_predictions = run_model(args.baseline, args.transcriptions, args.top_k)
+    candidate_predictions = run_model(args.candidate, args.transcriptions, args.top_k)
+    top1_agreement, topk_overlap = compare(baseline_predictions, candidate_predictions, args.top_k)
+
+    print(f"Transcriptions: {len(baseline_predictions)}")
+    print(f"Top-1 agreement: {top1_agreement:.3f}")
+    print(f"Mean top-{args.top_k} overlap: {topk_overlap:.3f}")
+    if top1_agreement >= MIN_TOP1_AGREEMENT:
+        print(f"{args.candidate} can replace {args.baseline} (MODEL_NAME={args.candidate})")
+    else:
+        print(f"{args.candidate} disagrees too often with {args.baseline}, keep the baseline")
+
+
+if __name__ == "__main__":
+    main()
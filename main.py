@@ -1,16 +1,21 @@
 import asyncio
-import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
+import orjson
 import pika
 import psycopg2  # For connecting to PostgreSQL
+import psycopg2.pool
 from fastapi import FastAPI, HTTPException
-from psycopg2.extras import execute_values
+from prometheus_client import make_asgi_app
 from pydantic import BaseModel
 
-from categorization import categorize_text_with_tags_and_category
+from categorization import categorize_text_with_tags_and_category, categorize_texts_with_tags_and_categories
+from model_loader import get_classifier
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -24,11 +29,24 @@ RABBITMQ_PASSWORD = os.getenv('SPRING_RABBITMQ_PASSWORD')
 TRANSCRIPTION_QUEUE = "transcription_queue"
 CATEGORIZATION_QUEUE = "categorization_queue"
 EXCHANGE_NAME = "categorization_exchange"
+# Transcriptions categorized together: up to CONSUMER_BATCH_SIZE messages, waiting at most
+# CONSUMER_BATCH_TIMEOUT seconds for the batch to fill up
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", "8"))
+CONSUMER_BATCH_TIMEOUT = float(os.getenv("CONSUMER_BATCH_TIMEOUT", "0.05"))
 
 DB_HOST = os.getenv("DB_HOST", "categorization_service_db_postgres")
 DB_NAME = os.getenv("DB_NAME", "categorization_service_db")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+DB_POOL_MIN_CONNECTIONS = int(os.getenv("DB_POOL_MIN_CONNECTIONS", "2"))
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", "10"))
+
+
+# Runs every classification, from HTTP requests and from the consumer, on a single
+# thread: it keeps the CPU-bound work off the event loop, never runs two forward passes
+# at once (each already spreads over INFERENCE_THREADS cores) and never uses the shared
+# tokenizer from two threads
+CLASSIFY_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classify")
 
 
 class TranscriptionRequest(BaseModel):
@@ -45,56 +63,152 @@ def get_rabbitmq_connection():
     )
 
 
-def send_to_queue(queue_name: str, message: dict):
-    """Send a categorized message to the next queue."""
-    try:
-        connection = get_rabbitmq_connection()
-        channel = connection.channel()
+# Publisher connection kept open across messages. pika connections are not
+# thread-safe, so every use of it goes through `publisher_lock`
+publisher_lock = threading.Lock()
+publisher_connection = None
+publisher_channel = None
+declared_queues = set()
+
+
+def get_publisher_channel():
+    """Return the shared publisher channel, connecting and declaring the exchange if needed."""
+    global publisher_connection, publisher_channel
+    if publisher_channel is None or publisher_channel.is_closed:
+        close_publisher_connection()
+        publisher_connection = get_rabbitmq_connection()
+        publisher_channel = publisher_connection.channel()
+        publisher_channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type="direct", durable=True)
+    return publisher_channel
+
+
+def close_publisher_connection():
+    """Close the shared publisher connection, ignoring errors from an already broken one."""
+    global publisher_connection, publisher_channel
+    if publisher_connection is not None and publisher_connection.is_open:
+        try:
+            publisher_connection.close()
+        except pika.exceptions.AMQPError as e:
+            logger.warning(f"Failed to close publisher connection: {e}")
+    publisher_connection = None
+    publisher_channel = None
+    declared_queues.clear()
+
 
-        # Declare the exchange and queue
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type="direct", durable=True)
+def publish(queue_name: str, message: dict):
+    """Publish a message on the shared channel, declaring and binding the queue on first use."""
+    channel = get_publisher_channel()
+
+    if queue_name not in declared_queues:
         channel.queue_declare(queue=queue_name, durable=True)
         channel.queue_bind(exchange=EXCHANGE_NAME, queue=queue_name, routing_key=queue_name)
+        declared_queues.add(queue_name)
+
+    # Publish the message as UTF-8 JSON; orjson does not escape non-ASCII characters
+    channel.basic_publish(
+        exchange=EXCHANGE_NAME,
+        routing_key=queue_name,
+        body=orjson.dumps(message),
+        properties=pika.BasicProperties(delivery_mode=2),  # Make message persistent
+    )
 
-        # Publish the message with `ensure_ascii=False` to prevent escaping non-ASCII characters
-        channel.basic_publish(
-            exchange=EXCHANGE_NAME,
-            routing_key=queue_name,
-            body=json.dumps(message, ensure_ascii=False),  # Avoid escaping non-ASCII characters
-            properties=pika.BasicProperties(delivery_mode=2),  # Make message persistent
-        )
-        logger.info(f"Message sent to queue '{queue_name}': {message}")
 
-        connection.close()
+def send_to_queue(queue_name: str, message: dict):
+    """Send a categorized message to the next queue."""
+    try:
+        with publisher_lock:
+            try:
+                publish(queue_name, message)
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                # The connection or channel was closed (e.g. broker restart, missed heartbeats):
+                # reconnect and retry once
+                logger.warning(f"Publisher connection lost, reconnecting: {e}")
+                close_publisher_connection()
+                publish(queue_name, message)
+        logger.info(f"Message sent to queue '{queue_name}': {message}")
     except Exception as e:
         logger.error(f"Failed to send message to queue '{queue_name}': {e}")
         raise e
 
 
-async def consume_messages():
-    """Consume messages from the transcription_queue."""
-    connection = get_rabbitmq_connection()
-    channel = connection.channel()
-    channel.queue_declare(queue=TRANSCRIPTION_QUEUE, durable=True)
+def categorize_messages(messages):
+    """Categorize the transcriptions of decoded messages together."""
+    return categorize_texts_with_tags_and_categories(
+        [message_data.get("transcription") for _, message_data in messages],
+        tags=[message_data.get("tags") for _, message_data in messages],
+        categories=[message_data.get("category") for _, message_data in messages],
+    )
+
+
+def categorize_message(message_data):
+    """Categorize the transcription of a single decoded message."""
+    return categorize_text_with_tags_and_category(
+        message_data.get("transcription"),
+        tags=message_data.get("tags"),
+        category=message_data.get("category"),
+    )
+
+
+def wait_for_classification(ch, future):
+    """Wait for a classification submitted to CLASSIFY_POOL and return its result.
+
+    The consumer's connection I/O loop keeps running meanwhile, so heartbeats are sent and the
+    next deliveries are received while the model runs.
+    """
+    while not future.done():
+        ch.connection.process_data_events(time_limit=0.1)
+    return future.result()
+
 
-    def callback(ch, method, properties, body):
+def process_messages(ch, deliveries):
+    """Categorize a batch of transcription messages with a single joint classification."""
+    # Decode the messages, rejecting the ones that cannot be categorized
+    messages = []
+    for method, body in deliveries:
+        try:
+            # Decode the message (orjson parses the UTF-8 bytes directly)
+            message_data = orjson.loads(body)
+            if not message_data.get("transcription"):
+                raise ValueError("Missing transcription text in message")
+            messages.append((method, message_data))
+        except Exception as e:
+            logger.error(f"Failed to process message: {e}")
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+
+    if not messages:
+        return
+
+    # Categorize all the transcriptions of the batch together
+    try:
+        categorized_messages = list(zip(
+            messages, wait_for_classification(ch, CLASSIFY_POOL.submit(categorize_messages, messages))
+        ))
+    except pika.exceptions.AMQPError:
+        # The consumer connection itself failed: nothing can be acked or nacked on it
+        raise
+    except Exception as e:
+        # Retry each message on its own, so one bad message does not fail (and requeue) the whole batch
+        logger.error(f"Failed to categorize messages together, retrying them one by one: {e}")
+        categorized_messages = []
+        for method, message_data in messages:
+            try:
+                categorization_result = wait_for_classification(
+                    ch, CLASSIFY_POOL.submit(categorize_message, message_data)
+                )
+                categorized_messages.append(((method, message_data), categorization_result))
+            except pika.exceptions.AMQPError:
+                raise
+            except Exception as message_error:
+                logger.error(f"Failed to process message: {message_error}")
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+
+    for (method, message_data), categorization_result in categorized_messages:
         try:
-            # Decode the message
-            message_data = json.loads(body.decode("utf-8"))
             transcription_text = message_data.get("transcription")
-            transcription_tags = message_data.get("tags")
-            transcription_category = message_data.get("category")
             channel_id = message_data.get("channelId")
             video_id = message_data.get("videoId")
             audio_part = message_data.get("audioPart")
 
-            if not transcription_text:
-                raise ValueError("Missing transcription text in message")
-
-            # Categorize the transcription
-            categorization_result = categorize_text_with_tags_and_category(transcription_text, tags=transcription_tags,
-                                                                           category=transcription_category)
-
             store_categorization(categorization_result, channel_id, video_id, audio_part)
 
             # Send the categorized message to the next queue
@@ -107,21 +221,83 @@ async def consume_messages():
             logger.error(f"Failed to process message: {e}")
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
 
-    channel.basic_consume(queue=TRANSCRIPTION_QUEUE, on_message_callback=callback, auto_ack=False)
+
+async def consume_messages():
+    """Consume messages from the transcription_queue."""
+    connection = get_rabbitmq_connection()
+    channel = connection.channel()
+    channel.queue_declare(queue=TRANSCRIPTION_QUEUE, durable=True)
+    # Allow two batches of unacked messages: while one batch is being categorized, the broker
+    # can already deliver the next one, so it is ready as soon as the current batch is acked
+    channel.basic_qos(prefetch_count=2 * CONSUMER_BATCH_SIZE)
+
+    def consume_batches():
+        """Group deliveries into batches of up to CONSUMER_BATCH_SIZE messages or CONSUMER_BATCH_TIMEOUT seconds."""
+        deliveries = []
+        batch_started = 0.0
+        # Yields (None, None, None) when no message arrives within the timeout
+        for method, properties, body in channel.consume(
+                TRANSCRIPTION_QUEUE, auto_ack=False, inactivity_timeout=CONSUMER_BATCH_TIMEOUT
+        ):
+            if method is not None:
+                if not deliveries:
+                    batch_started = time.monotonic()
+                deliveries.append((method, body))
+
+            if deliveries and (
+                    method is None
+                    or len(deliveries) >= CONSUMER_BATCH_SIZE
+                    or time.monotonic() - batch_started >= CONSUMER_BATCH_TIMEOUT
+            ):
+                process_messages(channel, deliveries)
+                deliveries = []
+
     logger.info("Started consuming messages from RabbitMQ transcription_queue")
-    await asyncio.get_event_loop().run_in_executor(None, channel.start_consuming)
+    await asyncio.get_event_loop().run_in_executor(None, consume_batches)
     connection.close()
 
 
+# PostgreSQL connections are pooled and reused across messages
+db_pool_lock = threading.Lock()
+db_pool = None
+
+
+def get_db_pool():
+    """Return the PostgreSQL connection pool, creating it on first use."""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn=DB_POOL_MIN_CONNECTIONS,
+                maxconn=DB_POOL_MAX_CONNECTIONS,
+                host=DB_HOST,
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD
+            )
+        return db_pool
+
+
+def release_db_connection(connection):
+    """Return a connection to the pool, discarding it if it was closed."""
+    # The pool rolls back any transaction left open on the connection
+    get_db_pool().putconn(connection, close=bool(connection.closed))
+
+
+def close_db_pool():
+    """Close every connection of the PostgreSQL connection pool."""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+
+
 def create_tables_if_not_exist():
     """Create the required database tables if they do not exist."""
+    connection = None
     try:
-        connection = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
+        connection = get_db_pool().getconn()
         cursor = connection.cursor()
 
         # SQL for creating tables
@@ -159,82 +335,95 @@ def create_tables_if_not_exist():
         connection.commit()
         logger.info("Tables ensured to exist in the database.")
 
+        cursor.close()
     except Exception as e:
         logger.info(f"Failed to create tables: {e}")
     finally:
         if connection:
-            cursor.close()
-            connection.close()
+            release_db_connection(connection)
 
 
-def store_categorization(categorization_result, channel_id, video_id, audio_part):
-    """Store categorization results in the PostgreSQL database."""
-    try:
-        connection = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        cursor = connection.cursor()
+def write_categorization(connection, categorization_result, channel_id, video_id, audio_part):
+    """Insert a categorization result and its categories in one transaction on the given connection."""
+    with connection.cursor() as cursor:
+        category_names = [
+            categorization.get("category") for categorization in categorization_result
+            if categorization.get("category")
+        ]
 
-        # Step 1: Insert into `categorization`
+        # Insert into `categorization` and the missing categories in a single statement.
+        # Existing categories are left untouched instead of being rewritten by a no-op update
         cursor.execute(
             """
-            INSERT INTO categorization (channel_id, video_id, audio_part)
-            VALUES (%s, %s, %s)
-            RETURNING id;
+            WITH new_categorization AS (
+                INSERT INTO categorization (channel_id, video_id, audio_part)
+                VALUES (%s, %s, %s)
+                RETURNING id
+            ), new_categories AS (
+                INSERT INTO category (name)
+                SELECT DISTINCT UNNEST(%s::text[])
+                ON CONFLICT (name) DO NOTHING
+            )
+            SELECT id FROM new_categorization;
             """,
-            (channel_id, video_id, audio_part)
+            (channel_id, video_id, audio_part, category_names)
         )
         categorization_id = cursor.fetchone()[0]
 
-        # Step 2: Insert into `category` and fetch category IDs
-        category_ids = []
-        for categorization in categorization_result:
-            category_name = categorization.get("category")
-            if category_name:
-                cursor.execute(
-                    """
-                    INSERT INTO category (name)
-                    VALUES (%s)
-                    ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
-                    RETURNING id;
-                    """,
-                    (category_name,)
-                )
-                category_ids.append(cursor.fetchone()[0])
-
-        # Step 3: Insert into `categorization_category`
-        categorization_category_values = [
-            (categorization_id, category_id) for category_id in category_ids
-        ]
-        execute_values(
-            cursor,
+        # Link the categories in a second statement: its fresh snapshot also sees the
+        # categories committed by concurrent transactions that DO NOTHING skipped
+        cursor.execute(
             """
             INSERT INTO categorization_category (categorization_id, category_id)
-            VALUES %s;
+            SELECT %s, id FROM category WHERE name = ANY(%s);
             """,
-            categorization_category_values
+            (categorization_id, category_names)
         )
 
-        # Commit the transaction
-        connection.commit()
-        logging.info("Data stored successfully in categorization service DB.")
+    # Commit the transaction
+    connection.commit()
+
 
+def store_categorization(categorization_result, channel_id, video_id, audio_part):
+    """Store categorization results in the PostgreSQL database.
+
+    Errors are raised to the caller, so the message is nacked and redelivered instead of acked.
+    """
+    connection = None
+    try:
+        connection = get_db_pool().getconn()
+        try:
+            write_categorization(connection, categorization_result, channel_id, video_id, audio_part)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            # A pooled connection can be stale (database restart, idle timeout, proxy drop):
+            # discard it and retry once on a fresh one
+            logger.warning(f"Database connection lost, retrying on a new connection: {e}")
+            get_db_pool().putconn(connection, close=True)
+            connection = None  # Already returned, must not be released again if getconn fails
+            connection = get_db_pool().getconn()
+            write_categorization(connection, categorization_result, channel_id, video_id, audio_part)
+        logging.info("Data stored successfully in categorization service DB.")
     except Exception as e:
         logging.error(f"Failed to store data: {e}")
+        raise e
     finally:
         if connection:
-            cursor.close()
-            connection.close()
-
+            release_db_connection(connection)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage the lifecycle of the RabbitMQ consumer."""
+    # Load the model before serving, so requests and the consumer share a single copy
+    get_classifier()
     create_tables_if_not_exist()
+    # RabbitMQ is not required to serve HTTP: broker or configuration errors
+    # (e.g. SPRING_RABBITMQ_PORT unset) are logged and the publish retries later
+    try:
+        with publisher_lock:
+            get_publisher_channel()
+    except Exception as e:
+        logger.error(f"Failed to open publisher connection, retrying on first publish: {e}")
     consumer_task = asyncio.create_task(consume_messages())
     yield
     consumer_task.cancel()
@@ -242,10 +431,16 @@ async def lifespan(app: FastAPI):
         await consumer_task
     except asyncio.CancelledError:
         pass
+    with publisher_lock:
+        close_publisher_connection()
+    close_db_pool()
+    CLASSIFY_POOL.shutdown(wait=False)
 
 
 # FastAPI setup with lifespan
 app = FastAPI(lifespan=lifespan)
+# Expose the Prometheus metrics
+app.mount("/metrics", make_asgi_app())
 
 
 @app.get("/")
@@ -257,7 +452,9 @@ async def root():
 async def categorize_text_request(transcription: TranscriptionRequest):
     """Categorize text via HTTP POST."""
     try:
-        category = categorize_text_with_tags_and_category(transcription.transcription)
+        category = await asyncio.get_running_loop().run_in_executor(
+            CLASSIFY_POOL, categorize_text_with_tags_and_category, transcription.transcription
+        )
         return {"category": category}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,79 @@
+import os
+from functools import lru_cache
+
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+# Specify the model name and revision. Model for zero-shot classification; MODEL_NAME can
+# select another MNLI model with the same tokenizer layout, e.g. the distilled
+# valhalla/distilbart-mnli-12-3 (about 3x faster on CPU). Run evaluate_models.py on held-out
+# transcriptions to check its rankings against bart-large-mnli before switching
+model_name = os.getenv("MODEL_NAME", "facebook/bart-large-mnli")
+revision = os.getenv("MODEL_REVISION", "main")
+
+# Number of threads used for CPU inference. Set it to the physical cores actually
+# available to the container: os.cpu_count() ignores CPU quotas, and oversubscribing
+# the cores makes the int8 kernels slower than fp32.
+# Set before the model is loaded; a single inter-op thread avoids competing thread pools
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "4"))
+torch.set_num_threads(INFERENCE_THREADS)
+torch.set_num_interop_threads(1)
+
+# Inference backend: "torch" (int8 dynamically quantized PyTorch model) or
+# "onnx" (int8 quantized ONNX graph served by ONNX Runtime)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+# Directory where the exported and quantized ONNX model is cached between runs,
+# one per model so changing MODEL_NAME does not reuse a stale export
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join("onnx_model", model_name))
+ONNX_MODEL_FILE = "model_quantized.onnx"
+
+
+def load_torch_model():
+    """Load the MNLI model with PyTorch and quantize it to int8."""
+    torch_model = AutoModelForSequenceClassification.from_pretrained(model_name, revision=revision)
+
+    # Quantize the Linear layers to int8 (dynamic quantization) to speed up CPU inference.
+    # Only the weights change, the order of the MNLI logits stays the same
+    torch_model = torch.ao.quantization.quantize_dynamic(torch_model, {torch.nn.Linear}, dtype=torch.qint8)
+    torch_model.eval()
+    return torch_model
+
+
+def load_onnx_model():
+    """Export the MNLI model to ONNX, quantize it to int8 and load it with ONNX Runtime."""
+    # Imported here so onnxruntime and optimum (requirements-onnx.txt) are only needed by the ONNX backend
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    # Export and quantize only once, later runs load the cached graph
+    if not os.path.exists(os.path.join(ONNX_MODEL_DIR, ONNX_MODEL_FILE)):
+        exported_model = ORTModelForSequenceClassification.from_pretrained(
+            model_name, revision=revision, export=True
+        )
+        quantizer = ORTQuantizer.from_pretrained(exported_model)
+        quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        quantizer.quantize(save_dir=ONNX_MODEL_DIR, quantization_config=quantization_config)
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = INFERENCE_THREADS
+    # The ORT model takes and returns torch tensors, so it is a drop-in for the PyTorch model
+    return ORTModelForSequenceClassification.from_pretrained(
+        ONNX_MODEL_DIR, file_name=ONNX_MODEL_FILE, session_options=session_options
+    )
+
+
+@lru_cache(maxsize=1)
+def get_classifier():
+    """Load the tokenizer and the MNLI model once and share them across the process."""
+    # Load the tokenizer and the MNLI model directly instead of going through the
+    # zero-shot pipeline, so the hypotheses can be tokenized once and reused.
+    # The model runs on CPU
+    tokenizer = AutoTokenizer.from_pretrained(model_name, revision=revision)
+    if INFERENCE_BACKEND == "onnx":
+        model = load_onnx_model()
+    elif INFERENCE_BACKEND == "torch":
+        model = load_torch_model()
+    else:
+        raise ValueError(f"Unsupported inference backend: {INFERENCE_BACKEND}")
+    return tokenizer, model